@@ -1,7 +1,13 @@
 # app.py
-from flask import Flask, render_template, request, redirect, url_for, flash, g
+from flask import Flask, render_template, request, redirect, url_for, flash, g, session, make_response, jsonify, abort
+import click
+from werkzeug.http import is_resource_modified
 import sqlite3
+from collections import OrderedDict
 from datetime import datetime
+from functools import wraps
+import hashlib
+import threading
 import sys
 import os
 
@@ -9,17 +15,46 @@ import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from shopping_db import OnlineShoppingDB
+from sharded_db import ShardedShoppingDB
 
 app = Flask(__name__)
 app.secret_key = 'your_super_secret_key'
 
 
 DATABASE = 'online_shopping.db'
+# 顧客分片數；0 表示不分片，所有資料表都在 DATABASE 中。
+# 分片時 CATALOG_DATABASE 作為共用商品目錄，顧客/訂單存放在 SHARD_DATABASES。
+SHARD_COUNT = int(os.environ.get('SHOP_SHARD_COUNT', '0'))
+CATALOG_DATABASE = os.environ.get('SHOP_CATALOG_DATABASE', DATABASE)
+SHARD_DATABASES = [f'online_shopping_shard{i}.db' for i in range(SHARD_COUNT)]
+
+RESHARD_HINT = "請停止應用程式並執行 flask --app app reshard 把既有的顧客與訂單搬移到分片。"
+
+
+def open_db():
+    """依設定建立單一或分片的資料庫物件。"""
+    if SHARD_DATABASES:
+        return ShardedShoppingDB(catalog_db=CATALOG_DATABASE, shard_dbs=SHARD_DATABASES)
+    return OnlineShoppingDB(db_name=DATABASE)
+
+# 每個行程只在第一次取得連線時檢查一次結構版本；檢查失敗時記下原因，之後的請求直接回傳 503
+_schema_checked = False
+_schema_error = None
 
 
 def get_db():
+    global _schema_checked, _schema_error
+    if _schema_error:
+        abort(503, _schema_error)
     if 'db' not in g:
-        g.db = OnlineShoppingDB(db_name=DATABASE)
+        g.db = open_db()
+        if not _schema_checked:
+            try:
+                g.db.migrate()
+            except RuntimeError as e:
+                _schema_error = f"{e} {RESHARD_HINT}"
+                abort(503, _schema_error)
+            _schema_checked = True
     return g.db
 
 @app.teardown_appcontext
@@ -28,7 +63,96 @@ def close_db(exception):
     if db_instance is not None:
         db_instance.close()
 
+
+# --- HTTP 快取 (ETag) ---
+# 伺服器端頁面快取的最大筆數；0 表示停用，只使用 ETag 條件式請求。
+PAGE_CACHE_SIZE = int(os.environ.get('SHOP_PAGE_CACHE_SIZE', '0'))
+_page_cache = OrderedDict()
+# 開發伺服器預設為多執行緒，所有 _page_cache 的存取都必須持有此鎖
+_page_cache_lock = threading.Lock()
+
+
+def _build_version():
+    """
+    程式與模板的版本，納入 ETag，部署新版本後舊的 ETag 即失效。
+    可用環境變數 SHOP_BUILD_VERSION 指定；未指定時以程式碼與模板內容的雜湊計算。
+    """
+    if os.environ.get('SHOP_BUILD_VERSION'):
+        return os.environ['SHOP_BUILD_VERSION']
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    paths = [os.path.join(base_dir, name) for name in ('app.py', 'shopping_db.py', 'sharded_db.py')]
+    template_dir = os.path.join(base_dir, 'templates')
+    paths += [os.path.join(template_dir, name) for name in sorted(os.listdir(template_dir))]
+    digest = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+BUILD_VERSION = _build_version()
+
+ALL_TABLES = ("Products", "Customers", "Suppliers", "Orders", "Order_Items", "Product_Suppliers")
+
+
+def conditional_page(*table_names):
+    """
+    GET 頁面的條件式快取：依程式版本、資料庫識別值與頁面用到的資料表變更版本產生 ETag。
+    用戶端帶著相同的 If-None-Match 時直接回傳 304，不查詢資料表也不渲染模板。
+    不送出 Last-Modified：HTTP 日期只精確到秒，同一秒內的寫入會被 If-Modified-Since 誤判為未修改。
+    資料庫識別值讓刪除重建後的資料庫即使計數器相同也會得到不同的 ETag。
+    啟用 PAGE_CACHE_SIZE 時，另外以 (程式版本, 路徑, 查詢參數, 資料庫識別值, 資料版本) 為鍵快取渲染好的回應。
+    session 中有尚未顯示的 flash 訊息時不使用快取，以免訊息被吞掉。
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET' or session.get('_flashes'):
+                return view(*args, **kwargs)
+
+            if table_names:
+                db = get_db()
+                database_id = db.database_id()
+                versions = db.table_versions(table_names)
+            else:
+                database_id, versions = None, {}
+            version_key = tuple(versions.get(name, (0, 0))[0] for name in table_names)
+            cache_key = (
+                BUILD_VERSION, request.path, tuple(sorted(request.args.items(multi=True))),
+                database_id, version_key
+            )
+            etag = hashlib.sha1(repr(cache_key).encode('utf-8')).hexdigest()
+
+            if not is_resource_modified(request.environ, etag=etag):
+                response = make_response('', 304)
+            else:
+                cached = None
+                if PAGE_CACHE_SIZE:
+                    with _page_cache_lock:
+                        cached = _page_cache.get(cache_key)
+                        if cached is not None:
+                            _page_cache.move_to_end(cache_key)
+                if cached is not None:
+                    body, mimetype = cached
+                    response = make_response(body)
+                    response.mimetype = mimetype
+                else:
+                    response = make_response(view(*args, **kwargs))
+                    if PAGE_CACHE_SIZE and response.status_code == 200:
+                        with _page_cache_lock:
+                            _page_cache[cache_key] = (response.get_data(), response.mimetype)
+                            while len(_page_cache) > PAGE_CACHE_SIZE:
+                                _page_cache.popitem(last=False)
+
+            response.set_etag(etag)
+            # 每次都向伺服器確認，確保資料變更後立即看到新內容
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
 @app.route('/search', methods=['GET'])
+@conditional_page(*ALL_TABLES)
 def search():
     db_instance = get_db()
     query_type = request.args.get('query_type')
@@ -115,6 +239,7 @@ def search():
 
 # --- 現有路由 (不變動) ---
 @app.route('/')
+@conditional_page(*ALL_TABLES)
 def index():
     # 初始顯示所有資料，不帶查詢條件
     db_instance = get_db()
@@ -271,13 +396,18 @@ def delete_customer(customer_id):
 
 # --- 訂單 (Orders) 操作 - 包含事務處理 ---
 @app.route('/orders/new', methods=['GET', 'POST'])
+@conditional_page()
 def new_order():
+    # 顧客與商品改由 /api/customers、/api/products 即時搜尋，頁面大小不隨資料量增加；
+    # 頁面不依賴任何資料表，ETag 只隨程式版本 (BUILD_VERSION) 改變
     db_instance = get_db()
-    customers = db_instance.fetch_all("Customers")
-    products = db_instance.fetch_all("Products")
 
     if request.method == 'POST':
-        customer_id = int(request.form['customer_id'])
+        try:
+            customer_id = int(request.form['customer_id'])
+        except (KeyError, ValueError):
+            flash("請從搜尋結果中選擇顧客。", 'danger')
+            return redirect(url_for('new_order'))
         product_ids = request.form.getlist('product_id[]')
         quantities = request.form.getlist('quantity[]')
 
@@ -305,52 +435,205 @@ def new_order():
             flash("建立訂單失敗，請檢查庫存或輸入。", 'danger')
         return redirect(url_for('index'))
 
-    return render_template('new_order.html', customers=customers, products=products)
+    return render_template('new_order.html')
+
+
+# --- JSON API：建立訂單頁面的即時搜尋與購物車報價 ---
+TYPEAHEAD_DEFAULT_LIMIT = 10
+TYPEAHEAD_MAX_LIMIT = 50
+
 
+def _typeahead_args():
+    """讀取 q 與 limit 參數；limit 限制在 1 ~ TYPEAHEAD_MAX_LIMIT。"""
+    prefix = request.args.get('q', '').strip()
+    limit = request.args.get('limit', TYPEAHEAD_DEFAULT_LIMIT, type=int)
+    return prefix, max(1, min(limit, TYPEAHEAD_MAX_LIMIT))
 
-# --- 應用程式啟動時的初始化資料 ---
-with app.app_context():
-    initial_db_instance = get_db()
-    if not initial_db_instance.fetch_all("Products"):
-        print("首次運行：插入初始範例資料...")
-        product1_id = initial_db_instance.insert_data("Products", {
+
+@app.route('/api/customers')
+@conditional_page("Customers")
+def api_customers():
+    """依姓名前綴搜尋顧客，只回傳 ID 與姓名。"""
+    prefix, limit = _typeahead_args()
+    if not prefix:
+        return jsonify([])
+    customers = get_db().fetch_by_prefix("Customers", ("customer_id", "name"), "name", prefix, limit)
+    return jsonify([{"customer_id": c[0], "name": c[1]} for c in customers])
+
+
+@app.route('/api/products')
+@conditional_page("Products")
+def api_products():
+    """依名稱前綴搜尋商品。"""
+    prefix, limit = _typeahead_args()
+    if not prefix:
+        return jsonify([])
+    products = get_db().fetch_by_prefix(
+        "Products", ("product_id", "name", "price", "stock_quantity"), "name", prefix, limit
+    )
+    return jsonify([
+        {"product_id": p[0], "name": p[1], "price": p[2], "stock_quantity": p[3]}
+        for p in products
+    ])
+
+
+def _is_sqlite_integer(value):
+    """是否為 SQLite INTEGER 範圍內的整數；拒絕 bool、浮點數與字串，不做隱性轉換。"""
+    return isinstance(value, int) and not isinstance(value, bool) and -2**63 <= value < 2**63
+
+
+@app.route('/api/cart/quote', methods=['POST'])
+def api_cart_quote():
+    """
+    購物車報價：以一次批次查詢取得所有商品的價格與庫存。
+    請求格式：{"items": [{"product_id": 1, "quantity": 2}, ...]}
+    """
+    payload = request.get_json(silent=True)
+    if payload is None:
+        payload = {}
+    if not isinstance(payload, dict) or not isinstance(payload.get("items", []), list):
+        return jsonify({"error": "請求格式不正確。"}), 400
+
+    items = []
+    for item in payload.get("items", []):
+        if not isinstance(item, dict) or not all(
+            _is_sqlite_integer(item.get(key)) for key in ("product_id", "quantity")
+        ):
+            return jsonify({"error": "商品數量或ID格式不正確。"}), 400
+        if item["quantity"] <= 0:
+            return jsonify({"error": "購買數量必須大於 0。"}), 400
+        items.append({"product_id": item["product_id"], "quantity": item["quantity"]})
+
+    # 同一商品出現在多列時，庫存檢查以總數量計算
+    requested = {}
+    for item in items:
+        requested[item["product_id"]] = requested.get(item["product_id"], 0) + item["quantity"]
+    products = {p[0]: p for p in get_db().fetch_many("Products", "product_id", list(requested))}
+
+    quoted_items = []
+    total = 0
+    for item in items:
+        product = products.get(item["product_id"])
+        if not product:
+            quoted_items.append({"product_id": item["product_id"], "quantity": item["quantity"], "error": "商品不存在。"})
+            continue
+        subtotal = product[3] * item["quantity"]
+        total += subtotal
+        quoted_items.append({
+            "product_id": product[0],
+            "name": product[1],
+            "quantity": item["quantity"],
+            "unit_price": product[3],
+            "subtotal": subtotal,
+            "in_stock": product[4] >= requested[product[0]],
+        })
+    return jsonify({"items": quoted_items, "total": total})
+
+
+# --- 資料庫初始化指令 ---
+# 結構遷移與範例資料都不在 import 時執行：
+#   flask --app app init-db    套用尚未執行的結構遷移（每次部署執行一次）
+#   flask --app app seed-demo  插入範例資料（僅在商品表為空時）
+#   flask --app app reshard    啟用分片時，把共用資料庫中既有的顧客與訂單搬移到分片
+#   flask --app app reconcile-stock  分片模式下處理結帳中斷時遺留的庫存保留紀錄
+def _migrate_or_fail(db_instance):
+    """套用遷移；分片模式下共用資料庫仍有未搬移的資料時，以說明訊息結束指令。"""
+    try:
+        return db_instance.migrate()
+    except RuntimeError as e:
+        raise click.ClickException(f"{e} {RESHARD_HINT}")
+
+
+@app.cli.command('init-db')
+def init_db_command():
+    """套用資料庫結構遷移。"""
+    db_instance = open_db()
+    try:
+        version = _migrate_or_fail(db_instance)
+        print(f"資料庫結構版本：{version}")
+    finally:
+        db_instance.close()
+
+
+@app.cli.command('reshard')
+def reshard_command():
+    """把共用資料庫中未分片的顧客、訂單與訂單明細搬移到分片，並依分片規則重新配發 ID。"""
+    if not SHARD_DATABASES:
+        raise click.ClickException("尚未啟用分片，請先設定 SHOP_SHARD_COUNT。")
+    db_instance = open_db()
+    try:
+        counts = db_instance.import_unsharded_data()
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    finally:
+        db_instance.close()
+    print(f"搬移完成：{counts}")
+
+
+@app.cli.command('reconcile-stock')
+@click.option('--older-than', default=300, show_default=True, help="只處理建立超過此秒數的保留紀錄。")
+def reconcile_stock_command(older_than):
+    """分片模式下，還原或清除結帳中斷時遺留的庫存保留紀錄。"""
+    if not SHARD_DATABASES:
+        raise click.ClickException("尚未啟用分片，未分片模式的結帳在單一事務中完成，不需要此指令。")
+    db_instance = open_db()
+    try:
+        _migrate_or_fail(db_instance)
+        db_instance.reconcile_reservations(older_than_seconds=older_than)
+    finally:
+        db_instance.close()
+
+
+@app.cli.command('seed-demo')
+def seed_demo_command():
+    """插入初始範例資料。"""
+    db_instance = open_db()
+    try:
+        _migrate_or_fail(db_instance)
+        if not db_instance.is_empty("Products"):
+            print("商品資料表已有資料，略過範例資料。")
+            return
+        print("插入初始範例資料...")
+        product1_id = db_instance.insert_data("Products", {
             "name": "無線藍牙耳機", "description": "高音質、舒適配戴",
             "price": 999.0, "stock_quantity": 50, "category": "電子產品"
         })
-        product2_id = initial_db_instance.insert_data("Products", {
+        product2_id = db_instance.insert_data("Products", {
             "name": "機械式鍵盤", "description": "青軸，手感極佳",
             "price": 1200.0, "stock_quantity": 30, "category": "電腦週邊"
         })
-        product3_id = initial_db_instance.insert_data("Products", {
+        product3_id = db_instance.insert_data("Products", {
             "name": "人體工學滑鼠", "description": "緩解手腕疲勞",
             "price": 450.0, "stock_quantity": 100, "category": "電腦週邊"
         })
 
-        supplier1_id = initial_db_instance.insert_data("Suppliers", {
+        supplier1_id = db_instance.insert_data("Suppliers", {
             "name": "XYZ 電子", "contact_email": "info@xyz.com",
             "phone": "02-12345678", "address": "台北市科技大道1號"
         })
-        supplier2_id = initial_db_instance.insert_data("Suppliers", {
+        supplier2_id = db_instance.insert_data("Suppliers", {
             "name": "ABC 周邊", "contact_email": "support@abc.com",
             "phone": "03-87654321", "address": "新北市創新園區2號"
         })
 
         if product1_id and supplier1_id:
-            initial_db_instance.insert_data("Product_Suppliers", {"product_id": product1_id, "supplier_id": supplier1_id, "supply_price": 750.0})
+            db_instance.insert_data("Product_Suppliers", {"product_id": product1_id, "supplier_id": supplier1_id, "supply_price": 750.0})
         if product2_id and supplier2_id:
-            initial_db_instance.insert_data("Product_Suppliers", {"product_id": product2_id, "supplier_id": supplier2_id, "supply_price": 900.0})
+            db_instance.insert_data("Product_Suppliers", {"product_id": product2_id, "supplier_id": supplier2_id, "supply_price": 900.0})
         if product3_id and supplier2_id:
-            initial_db_instance.insert_data("Product_Suppliers", {"product_id": product3_id, "supplier_id": supplier2_id, "supply_price": 300.0})
+            db_instance.insert_data("Product_Suppliers", {"product_id": product3_id, "supplier_id": supplier2_id, "supply_price": 300.0})
 
-        customer1_id = initial_db_instance.insert_data("Customers", {
+        db_instance.insert_data("Customers", {
             "name": "王小明", "email": "xiaoming@example.com",
             "password": "hashed_password_1", "phone": "0912-345678", "address": "台中市西區民生路"
         })
-        customer2_id = initial_db_instance.insert_data("Customers", {
+        db_instance.insert_data("Customers", {
             "name": "陳美麗", "email": "meili@example.com",
             "password": "hashed_password_2", "phone": "0987-654321", "address": "高雄市左營區勝利路"
         })
         print("初始資料插入完成。")
+    finally:
+        db_instance.close()
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
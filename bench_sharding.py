@@ -0,0 +1,123 @@
+# bench_sharding.py
+"""
+結帳吞吐量基準測試：比較不同分片數與工作行程數下，每秒可完成的訂單數。
+
+用法：
+    python bench_sharding.py
+    python bench_sharding.py --shards 1 2 4 --workers 1 2 4 8 --orders 300
+
+每個組合都在暫存目錄中建立全新的資料庫，每個工作行程各自開啟連線，
+對隨機顧客執行 add_order_and_items_transaction()。
+"shards=0" 代表未分片的 OnlineShoppingDB 作為比較基準；兩者都使用 WAL、相同的鎖定等待時間
+與 BEGIN IMMEDIATE，failed 欄為因鎖定逾時等原因失敗的訂單數。
+
+每筆結帳都要寫入共用資料庫扣除庫存，因此結帳吞吐量受限於共用資料庫的單一寫入者，
+預期不會隨分片數增加。單核心環境的一次測試 (--shards 0 1 2 4 --workers 1 4 8 --orders 100)：
+未分片約 1700-2700 orders/s，1-4 個分片約 900-1500 orders/s (分片結帳需在共用資料庫提交兩次：
+扣庫存與保留紀錄、刪除保留紀錄)，所有組合都沒有失敗的訂單。
+尚未在多核心機器上量測。
+"""
+import argparse
+import contextlib
+import io
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from shopping_db import OnlineShoppingDB
+from sharded_db import ShardedShoppingDB
+
+PRODUCT_COUNT = 50
+CUSTOMERS_PER_WORKER = 20
+
+
+def _open(workdir, shard_count):
+    catalog = os.path.join(workdir, "catalog.db")
+    if shard_count == 0:
+        # 基準組與分片組使用相同的 WAL 與鎖定等待設定，比較才公平
+        db = OnlineShoppingDB(db_name=catalog)
+        db.enable_wal()
+        return db
+    shards = [os.path.join(workdir, f"shard{i}.db") for i in range(shard_count)]
+    return ShardedShoppingDB(catalog_db=catalog, shard_dbs=shards)
+
+
+def _setup(workdir, shard_count, customer_count):
+    db = _open(workdir, shard_count)
+    db.migrate()
+    for i in range(PRODUCT_COUNT):
+        db.insert_data("Products", {
+            "name": f"商品 {i}", "description": "", "price": 10.0 + i,
+            "stock_quantity": 10_000_000, "category": "測試"
+        })
+    customer_ids = [
+        db.insert_data("Customers", {
+            "name": f"顧客 {i}", "email": f"user{i}@example.com", "password": "x"
+        })
+        for i in range(customer_count)
+    ]
+    db.close()
+    return customer_ids
+
+
+def _worker(workdir, shard_count, customer_ids, orders, seed, barrier, results):
+    rng = random.Random(seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        db = _open(workdir, shard_count)
+        barrier.wait()
+        succeeded = 0
+        for _ in range(orders):
+            product_details = [
+                {'product_id': product_id, 'quantity': rng.randint(1, 3)}
+                for product_id in rng.sample(range(1, PRODUCT_COUNT + 1), 3)
+            ]
+            if db.add_order_and_items_transaction(rng.choice(customer_ids), product_details):
+                succeeded += 1
+        db.close()
+    results.put(succeeded)
+
+
+def run(shard_count, workers, orders_per_worker):
+    """回傳 (成功訂單數, 秒數)。"""
+    with tempfile.TemporaryDirectory() as workdir:
+        with contextlib.redirect_stdout(io.StringIO()):
+            customer_ids = _setup(workdir, shard_count, CUSTOMERS_PER_WORKER * workers)
+        barrier = multiprocessing.Barrier(workers + 1)
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(
+                target=_worker,
+                args=(workdir, shard_count, customer_ids, orders_per_worker, seed, barrier, results)
+            )
+            for seed in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        barrier.wait()
+        start = time.perf_counter()
+        succeeded = sum(results.get() for _ in processes)
+        elapsed = time.perf_counter() - start
+        for process in processes:
+            process.join()
+    return succeeded, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", type=int, nargs="+", default=[0, 1, 2, 4, 8])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--orders", type=int, default=200, help="每個工作行程的訂單數")
+    args = parser.parse_args()
+
+    print(f"{'shards':>6} {'workers':>7} {'orders':>7} {'failed':>7} {'seconds':>8} {'orders/s':>9}")
+    for shard_count in args.shards:
+        for workers in args.workers:
+            succeeded, elapsed = run(shard_count, workers, args.orders)
+            failed = workers * args.orders - succeeded
+            print(f"{shard_count:>6} {workers:>7} {succeeded:>7} {failed:>7} {elapsed:>8.2f} {succeeded / elapsed:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
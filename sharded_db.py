@@ -0,0 +1,648 @@
+"""
+依 customer_id 分片的資料庫後端。
+
+吞吐量限制：每筆結帳都必須在共用資料庫上以 BEGIN IMMEDIATE 扣除庫存，
+共用資料庫同一時間只有一個寫入者，因此結帳吞吐量無法超過這個單一寫入者的上限；
+分片還會讓每筆結帳需要三次提交 (共用資料庫兩次：扣庫存與保留紀錄、刪除保留紀錄；分片一次)。
+分片分散的是顧客、訂單與訂單明細的儲存與其他寫入 (新增顧客、修改訂單等)，
+並不會讓結帳隨分片數增加而變快。實測數據見 bench_sharding.py。
+"""
+import json
+import sqlite3
+import string
+import zlib
+from datetime import datetime, timedelta
+
+from shopping_db import (
+    OnlineShoppingDB, table_version_statements,
+    PRODUCTS_DDL, SUPPLIERS_DDL, PRODUCT_SUPPLIERS_DDL, PRODUCTS_NAME_INDEX, CUSTOMERS_NAME_INDEX,
+)
+
+# 與 SQLite 內建 NOCASE 定序相同的大小寫轉換：只處理 ASCII 字母
+_NOCASE_FOLD = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+CATALOG_TABLES = ("Products", "Suppliers", "Product_Suppliers")
+SHARDED_TABLES = ("Customers", "Orders", "Order_Items")
+
+# --- 商品目錄資料庫結構 (Catalog Migrations) ---
+# 分片模式下的共用資料庫只存放商品目錄，不建立顧客/訂單資料表。
+CATALOG_MIGRATIONS = [
+    (1, "建立商品目錄資料表", [PRODUCTS_DDL, SUPPLIERS_DDL, PRODUCT_SUPPLIERS_DDL]),
+    (2, "新增資料表變更版本 (table_versions)", table_version_statements(list(CATALOG_TABLES))),
+    (3, "新增名稱前綴查詢索引", [PRODUCTS_NAME_INDEX]),
+    # 結帳時已扣除、但訂單尚未確認寫入分片的庫存；items 為 JSON [[product_id, quantity], ...]
+    (4, "新增庫存保留紀錄 (stock_reservations)", [
+        """
+        CREATE TABLE IF NOT EXISTS stock_reservations (
+            reservation_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            customer_id INTEGER NOT NULL,
+            items TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        );
+        """,
+    ]),
+]
+
+# --- 分片資料庫結構 (Shard Migrations) ---
+# 分片只存放顧客相關資料，資料表結構刻意與 shopping_db 的版本不同：
+# Order_Items 不宣告指向 Products 的外鍵，因為商品目錄位於另一個資料庫檔案，SQLite 的外鍵無法跨檔案；
+# customer_id / order_id 由 ShardedShoppingDB 指定，因此不使用 AUTOINCREMENT。
+SHARD_MIGRATIONS = [
+    (1, "建立分片資料表", [
+        """
+        CREATE TABLE IF NOT EXISTS Customers (
+            customer_id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            phone TEXT,
+            address TEXT
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS Orders (
+            order_id INTEGER PRIMARY KEY,
+            customer_id INTEGER NOT NULL,
+            order_date TEXT NOT NULL,
+            status TEXT NOT NULL,
+            total_amount REAL NOT NULL,
+            FOREIGN KEY (customer_id) REFERENCES Customers(customer_id) ON DELETE CASCADE
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS Order_Items (
+            order_id INTEGER,
+            product_id INTEGER,
+            quantity INTEGER NOT NULL,
+            unit_price REAL NOT NULL,
+            PRIMARY KEY (order_id, product_id),
+            FOREIGN KEY (order_id) REFERENCES Orders(order_id) ON DELETE CASCADE
+        );
+        """,
+    ]),
+    (2, "新增資料表變更版本 (table_versions)", table_version_statements(
+        ["Customers", "Orders", "Order_Items"]
+    )),
+    (3, "新增名稱前綴查詢索引", [CUSTOMERS_NAME_INDEX]),
+    # 每個分片已配發過的最大 ID；與 AUTOINCREMENT 相同，刪除資料後也不會重複使用 ID
+    (4, "新增分片 ID 序號表 (shard_sequence)", [
+        """
+        CREATE TABLE IF NOT EXISTS shard_sequence (
+            table_name TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL
+        );
+        """,
+        """
+        INSERT OR IGNORE INTO shard_sequence (table_name, last_id)
+        SELECT 'Customers', MAX(customer_id) FROM Customers HAVING MAX(customer_id) IS NOT NULL;
+        """,
+        """
+        INSERT OR IGNORE INTO shard_sequence (table_name, last_id)
+        SELECT 'Orders', MAX(order_id) FROM Orders HAVING MAX(order_id) IS NOT NULL;
+        """,
+    ]),
+    # 與訂單在同一個事務中寫入，reconcile_reservations() 據此判斷保留紀錄對應的訂單是否已成立
+    (5, "新增訂單保留紀錄對應表 (order_reservations)", [
+        """
+        CREATE TABLE IF NOT EXISTS order_reservations (
+            reservation_id INTEGER PRIMARY KEY,
+            order_id INTEGER NOT NULL
+        );
+        """,
+    ]),
+]
+
+# 各分片資料表的主鍵欄位數，用於合併多個分片結果時排序
+_PRIMARY_KEY_WIDTH = {"Customers": 1, "Orders": 1, "Order_Items": 2}
+
+
+class ShardedShoppingDB:
+    """
+    依 customer_id 分片的資料庫，提供與 OnlineShoppingDB 相同的介面。
+
+    - 商品目錄 (Products, Suppliers, Product_Suppliers) 存放在共用的 catalog 資料庫。
+    - Customers, Orders, Order_Items 依 customer_id 分散到 N 個分片檔案。
+
+    分片規則：customer_id % N 即為分片編號。每個分片只配發與自己編號同餘的 ID
+    (例如 N=4 時分片 1 配發 1, 5, 9, ...)，訂單 ID 也使用顧客所在分片的餘數，
+    因此只要知道 customer_id 或 order_id 就能直接找到分片。
+    分片數在有資料之後不可更改。
+
+    共用資料庫若是原本未分片的資料庫 (例如既有的 online_shopping.db)，其中的顧客與訂單
+    不會自動搬移到分片；migrate() 偵測到這些資料時會拒絕啟動分片模式，以免資料被隱藏。
+    請先以 import_unsharded_data() 把資料搬移到分片。
+    """
+
+    def __init__(self, catalog_db="online_shopping.db", shard_dbs=("online_shopping_shard0.db",)):
+        """
+        catalog_db: 共用商品目錄資料庫檔案。
+        shard_dbs: 分片資料庫檔案列表，順序即為分片編號。
+        """
+        if not shard_dbs:
+            raise ValueError("至少需要一個分片資料庫。")
+        self.catalog = OnlineShoppingDB(db_name=catalog_db, migrations=CATALOG_MIGRATIONS)
+        self.shards = [OnlineShoppingDB(db_name=name, migrations=SHARD_MIGRATIONS) for name in shard_dbs]
+        # 多個行程同時寫入共用資料庫與分片，使用 WAL 並等待鎖而不是立即失敗
+        for db in [self.catalog] + self.shards:
+            db.enable_wal()
+
+    @property
+    def cursor(self):
+        """商品目錄的 cursor，供直接查詢 Products 等共用資料表。"""
+        return self.catalog.cursor
+
+    @property
+    def shard_count(self):
+        return len(self.shards)
+
+    def migrate(self):
+        """
+        對商品目錄與所有分片套用遷移腳本，回傳商品目錄的結構版本。
+        共用資料庫中仍有未分片的顧客/訂單資料時拋出 RuntimeError。
+        """
+        self._check_catalog_has_no_shard_data()
+        for shard in self.shards:
+            shard.migrate()
+        return self.catalog.migrate()
+
+    def _unsharded_tables(self):
+        """共用資料庫中由未分片模式建立、且仍有資料的 Customers/Orders/Order_Items。"""
+        existing_tables = {row[0] for row in self.catalog.conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"
+        )}
+        return [
+            table_name for table_name in SHARDED_TABLES
+            if table_name in existing_tables and not self.catalog.is_empty(table_name)
+        ]
+
+    def _check_catalog_has_no_shard_data(self):
+        """
+        共用資料庫由未分片模式建立時會有自己的 Customers/Orders/Order_Items。
+        這些資料的 ID 不符合分片規則，分片模式也讀不到它們，因此不允許在此狀態下啟動。
+        """
+        tables = self._unsharded_tables()
+        if tables:
+            raise RuntimeError(
+                f"共用資料庫 {self.catalog.db_name} 的 {', '.join(tables)} 仍有未分片的資料，"
+                "分片模式無法存取這些資料；請先把資料搬移到分片，或停用分片 (SHOP_SHARD_COUNT=0)。"
+            )
+
+    def import_unsharded_data(self):
+        """
+        把共用資料庫中未分片模式留下的 Customers/Orders/Order_Items 搬移到各分片，
+        並依分片規則重新配發 customer_id / order_id。
+        只能在所有分片都沒有顧客資料時執行，執行期間應用程式必須停止。
+        先提交所有分片的寫入，再刪除共用資料庫中的舊資料；若中途失敗，共用資料庫的資料仍完整保留，
+        刪除分片檔案後即可重新執行。
+        回傳 {資料表名稱: 搬移筆數}。
+        """
+        self.catalog.migrate()
+        for shard in self.shards:
+            shard.migrate()
+        if not self._unsharded_tables():
+            return {table_name: 0 for table_name in SHARDED_TABLES}
+        if not self.is_empty("Customers") or not self.is_empty("Orders"):
+            raise RuntimeError("分片中已有顧客或訂單資料，無法搬移未分片的資料。")
+
+        catalog = self.catalog.conn
+        customers = catalog.execute(
+            "SELECT customer_id, name, email, password, phone, address FROM Customers ORDER BY customer_id"
+        ).fetchall()
+        orders = catalog.execute(
+            "SELECT order_id, customer_id, order_date, status, total_amount FROM Orders ORDER BY order_id"
+        ).fetchall()
+        order_items = catalog.execute(
+            "SELECT order_id, product_id, quantity, unit_price FROM Order_Items ORDER BY order_id, product_id"
+        ).fetchall()
+
+        try:
+            for shard in self.shards:
+                shard.conn.execute("BEGIN IMMEDIATE;")
+
+            customer_ids = {}
+            for old_id, name, email, password, phone, address in customers:
+                shard_index = self.shard_index_for_email(email)
+                new_id = self._next_id(shard_index, "Customers")
+                self.shards[shard_index].conn.execute(
+                    "INSERT INTO Customers (customer_id, name, email, password, phone, address) VALUES (?, ?, ?, ?, ?, ?)",
+                    (new_id, name, email, password, phone, address)
+                )
+                customer_ids[old_id] = new_id
+
+            order_ids = {}
+            for old_id, old_customer_id, order_date, status, total_amount in orders:
+                if old_customer_id not in customer_ids:
+                    raise RuntimeError(f"訂單 ID {old_id} 的顧客 ID {old_customer_id} 不存在。")
+                customer_id = customer_ids[old_customer_id]
+                shard_index = self.shard_index_for_customer(customer_id)
+                new_id = self._next_id(shard_index, "Orders")
+                self.shards[shard_index].conn.execute(
+                    "INSERT INTO Orders (order_id, customer_id, order_date, status, total_amount) VALUES (?, ?, ?, ?, ?)",
+                    (new_id, customer_id, order_date, status, total_amount)
+                )
+                order_ids[old_id] = new_id
+
+            for old_order_id, product_id, quantity, unit_price in order_items:
+                if old_order_id not in order_ids:
+                    raise RuntimeError(f"訂單明細所屬的訂單 ID {old_order_id} 不存在。")
+                order_id = order_ids[old_order_id]
+                self.shards[order_id % self.shard_count].conn.execute(
+                    "INSERT INTO Order_Items (order_id, product_id, quantity, unit_price) VALUES (?, ?, ?, ?)",
+                    (order_id, product_id, quantity, unit_price)
+                )
+
+            for shard in self.shards:
+                shard.conn.commit()
+        except Exception:
+            for shard in self.shards:
+                shard.conn.rollback()
+            raise
+
+        catalog.execute("BEGIN IMMEDIATE;")
+        catalog.execute("DELETE FROM Order_Items;")
+        catalog.execute("DELETE FROM Orders;")
+        catalog.execute("DELETE FROM Customers;")
+        catalog.commit()
+        print(f"已將 {len(customers)} 位顧客、{len(orders)} 筆訂單、{len(order_items)} 筆訂單明細搬移到 {self.shard_count} 個分片。")
+        return {"Customers": len(customers), "Orders": len(orders), "Order_Items": len(order_items)}
+
+    def close(self):
+        """關閉所有資料庫連接。"""
+        self.catalog.close()
+        for shard in self.shards:
+            shard.close()
+
+    def is_empty(self, table_name):
+        """檢查資料表是否沒有任何資料；分片資料表需所有分片皆為空。"""
+        if table_name not in SHARDED_TABLES:
+            return self.catalog.is_empty(table_name)
+        return all(shard.is_empty(table_name) for shard in self.shards)
+
+    def database_id(self):
+        """回傳共用資料庫與各分片 database_id() 組成的 tuple，任一檔案重建都會改變。"""
+        return (self.catalog.database_id(),) + tuple(shard.database_id() for shard in self.shards)
+
+    def table_versions(self, table_names):
+        """
+        回傳 {資料表名稱: (變更版本, 最後修改時間)}。
+        分片資料表的版本為各分片版本的總和（各分片只會遞增，因此總和變動即代表有寫入），
+        最後修改時間取各分片的最大值。
+        """
+        catalog_tables = [name for name in table_names if name not in SHARDED_TABLES]
+        sharded_tables = [name for name in table_names if name in SHARDED_TABLES]
+        versions = self.catalog.table_versions(catalog_tables) if catalog_tables else {}
+        if sharded_tables:
+            for shard in self.shards:
+                for table_name, (version, updated_at) in shard.table_versions(sharded_tables).items():
+                    total, latest = versions.get(table_name, (0, 0))
+                    versions[table_name] = (total + version, max(latest, updated_at))
+        return versions
+
+    # --- 分片路由 (Routing) ---
+    def shard_index_for_customer(self, customer_id):
+        """回傳顧客所在的分片編號。"""
+        return int(customer_id) % self.shard_count
+
+    def shard_index_for_email(self, email):
+        """
+        新顧客依 Email 雜湊分配分片，只用於平均分散資料。
+        顧客修改 Email 後不會搬移分片，因此各分片的 UNIQUE 約束不足以保證 Email 全域唯一，
+        新增或修改 Email 前需另外呼叫 _email_taken() 檢查所有分片。
+        """
+        return zlib.crc32(email.encode("utf-8")) % self.shard_count
+
+    def _email_taken(self, email, customer_id=None):
+        """
+        檢查所有分片中是否已有其他顧客 (customer_id 以外) 使用此 Email。
+        檢查與寫入分屬不同的資料庫檔案，同時對兩個分片寫入相同 Email 仍可能在極短時間內重複。
+        """
+        for shard in self.shards:
+            row = shard.fetch_one("Customers", {"email": email})
+            if row and row[0] != customer_id:
+                return True
+        return False
+
+    def _shard_index(self, table_name, conditions):
+        """
+        依查詢條件找出唯一的分片；無法判斷時回傳 None，由呼叫端對所有分片查詢。
+        訂單 ID 與顧客 ID 同餘，因此 order_id 也能直接決定分片。
+        """
+        if not conditions:
+            return None
+        if table_name in ("Customers", "Orders") and "customer_id" in conditions:
+            return self.shard_index_for_customer(conditions["customer_id"])
+        if table_name in ("Orders", "Order_Items") and "order_id" in conditions:
+            return int(conditions["order_id"]) % self.shard_count
+        return None
+
+    def _target_shards(self, table_name, conditions):
+        index = self._shard_index(table_name, conditions)
+        if index is None:
+            return self.shards
+        return [self.shards[index]]
+
+    def _next_id(self, shard_index, table_name):
+        """
+        在分片的寫入事務中配發下一個 ID，必須在 BEGIN IMMEDIATE 之後呼叫。
+        分片 i 只配發 i, i+N, i+2N...（分片 0 從 N 開始，避免 ID 為 0）。
+        已配發的最大 ID 記錄在 shard_sequence，與新增資料在同一個事務中更新，
+        因此刪除最後一筆資料後 ID 也不會被重複使用。
+        """
+        shard = self.shards[shard_index]
+        row = shard.conn.execute(
+            "SELECT last_id FROM shard_sequence WHERE table_name = ?", (table_name,)
+        ).fetchone()
+        next_id = (shard_index or self.shard_count) if row is None else row[0] + self.shard_count
+        shard.conn.execute(
+            "INSERT OR REPLACE INTO shard_sequence (table_name, last_id) VALUES (?, ?)",
+            (table_name, next_id)
+        )
+        return next_id
+
+    # --- 查詢 (Retrieve) ---
+    def fetch_all(self, table_name, conditions=None):
+        """
+        從指定資料表中獲取所有資料。
+        分片資料表若無法由條件決定分片，會查詢所有分片並依主鍵合併結果 (scatter-gather)。
+        """
+        if table_name not in SHARDED_TABLES:
+            return self.catalog.fetch_all(table_name, conditions)
+        shards = self._target_shards(table_name, conditions)
+        if len(shards) == 1:
+            return shards[0].fetch_all(table_name, conditions)
+        rows = []
+        for shard in shards:
+            rows.extend(shard.fetch_all(table_name, conditions))
+        key_width = _PRIMARY_KEY_WIDTH[table_name]
+        rows.sort(key=lambda row: row[:key_width])
+        return rows
+
+    def fetch_one(self, table_name, conditions):
+        """從指定資料表中獲取一筆資料；無法決定分片時依序查詢各分片。"""
+        if table_name not in SHARDED_TABLES:
+            return self.catalog.fetch_one(table_name, conditions)
+        for shard in self._target_shards(table_name, conditions):
+            row = shard.fetch_one(table_name, conditions)
+            if row:
+                return row
+        return None
+
+    def fetch_by_prefix(self, table_name, columns, column, prefix, limit=10):
+        """
+        依欄位前綴查詢；分片資料表由各分片各取 limit 筆，合併排序後取前 limit 筆。
+        合併時的排序與 SQLite 的 NOCASE 相同：只把 ASCII 大寫轉成小寫，其餘字元依碼位比較。
+        """
+        if table_name not in SHARDED_TABLES:
+            return self.catalog.fetch_by_prefix(table_name, columns, column, prefix, limit)
+        rows = []
+        for shard in self.shards:
+            rows.extend(shard.fetch_by_prefix(table_name, columns, column, prefix, limit))
+        column_index = list(columns).index(column)
+        rows.sort(key=lambda row: (row[column_index].translate(_NOCASE_FOLD), row[0]))
+        return rows[:limit]
+
+    def fetch_many(self, table_name, column, values):
+        """以 IN 查詢取得多筆資料；分片資料表對每個分片各查詢一次。"""
+        if table_name not in SHARDED_TABLES:
+            return self.catalog.fetch_many(table_name, column, values)
+        rows = []
+        for shard in self.shards:
+            rows.extend(shard.fetch_many(table_name, column, values))
+        return rows
+
+    # --- 新增 (Insert) ---
+    def insert_data(self, table_name, data):
+        """
+        向指定資料表插入一筆新資料。
+        Customers 依 Email 分配分片並配發 ID；Orders 寫入顧客所在分片；
+        Order_Items 寫入訂單所在分片。
+        """
+        if table_name not in SHARDED_TABLES:
+            return self.catalog.insert_data(table_name, data)
+
+        if table_name == "Customers":
+            if self._email_taken(data["email"]):
+                print(f"插入資料到 '{table_name}' 失敗: Email '{data['email']}' 已被使用。")
+                return None
+            shard_index = self.shard_index_for_email(data["email"])
+            id_column = "customer_id"
+        elif table_name == "Orders":
+            shard_index = self.shard_index_for_customer(data["customer_id"])
+            id_column = "order_id"
+        else:
+            return self.shards[int(data["order_id"]) % self.shard_count].insert_data(table_name, data)
+
+        shard = self.shards[shard_index]
+        try:
+            shard.conn.execute("BEGIN IMMEDIATE;")
+            row_data = dict(data)
+            row_data[id_column] = self._next_id(shard_index, table_name)
+            columns = ', '.join(row_data.keys())
+            placeholders = ', '.join(['?' for _ in row_data.values()])
+            shard.cursor.execute(
+                f"INSERT INTO {table_name} ({columns}) VALUES ({placeholders})", list(row_data.values())
+            )
+            shard.conn.commit()
+            print(f"資料成功插入到 '{table_name}' (分片 {shard_index})。ID: {row_data[id_column]}")
+            return row_data[id_column]
+        except sqlite3.Error as e:
+            shard.conn.rollback()
+            print(f"插入資料到 '{table_name}' 失敗: {e}")
+            return None
+
+    # --- 更新 (Update) ---
+    def update_data(self, table_name, data, conditions):
+        """
+        更新指定資料表中的資料；無法決定分片時更新所有分片並回傳總筆數。
+        修改顧客 Email 時必須以 customer_id 指定顧客，並先檢查所有分片是否已有相同 Email。
+        """
+        if table_name not in SHARDED_TABLES:
+            return self.catalog.update_data(table_name, data, conditions)
+        if table_name == "Customers" and "email" in data:
+            if "customer_id" not in conditions:
+                print(f"更新資料到 '{table_name}' 失敗: 修改 Email 必須指定 customer_id。")
+                return None
+            if self._email_taken(data["email"], int(conditions["customer_id"])):
+                print(f"更新資料到 '{table_name}' 失敗: Email '{data['email']}' 已被使用。")
+                return None
+        return self._sum_rowcounts(
+            shard.update_data(table_name, data, conditions)
+            for shard in self._target_shards(table_name, conditions)
+        )
+
+    # --- 刪除 (Delete) ---
+    def delete_data(self, table_name, conditions):
+        """
+        從指定資料表中刪除資料；無法決定分片時刪除所有分片並回傳總筆數。
+        注意：刪除商品不會連帶刪除分片中的訂單明細（外鍵無法跨檔案）。
+        """
+        if table_name not in SHARDED_TABLES:
+            return self.catalog.delete_data(table_name, conditions)
+        return self._sum_rowcounts(
+            shard.delete_data(table_name, conditions)
+            for shard in self._target_shards(table_name, conditions)
+        )
+
+    @staticmethod
+    def _sum_rowcounts(rowcounts):
+        """合併各分片的 rowcount；任一分片失敗 (None) 則回傳 None。"""
+        rowcounts = list(rowcounts)
+        if any(count is None for count in rowcounts):
+            return None
+        return sum(rowcounts)
+
+    # --- 跨資料庫的訂單事務 ---
+    def add_order_and_items_transaction(self, customer_id, product_details):
+        """
+        新增一筆訂單及其多個訂單明細，並扣除共用商品目錄的庫存。
+
+        庫存與訂單位於不同的資料庫檔案，無法在同一個事務中完成，因此分三步：
+        1. 在商品目錄的事務中檢查並扣除庫存，同時寫入一筆 stock_reservations 保留紀錄。
+        2. 在顧客所在分片的事務中寫入訂單、明細，以及 order_reservations (保留紀錄 -> 訂單)。
+        3. 刪除商品目錄中的保留紀錄。
+        第 2 步失敗時，會在同一個事務中把庫存加回並刪除保留紀錄。
+
+        保證：庫存不會被超賣，已扣除的庫存一定對應到一筆訂單或一筆保留紀錄。
+        若補償失敗 (例如鎖定逾時) 或行程在步驟之間中止，庫存會暫時偏低，
+        保留紀錄會留在 stock_reservations，需由 reconcile_reservations() 依分片中是否有訂單來還原或清除。
+
+        customer_id: 顧客ID
+        product_details: 列表，每個元素為字典 {'product_id': id, 'quantity': qty}
+        """
+        catalog = self.catalog
+        # 1. 在商品目錄中扣除庫存並記錄保留紀錄
+        try:
+            catalog.conn.execute("BEGIN IMMEDIATE;")
+            total_amount = 0
+            unit_prices = {}
+            for item in product_details:
+                product_id = item['product_id']
+                quantity = item['quantity']
+                product_info = catalog.conn.execute(
+                    "SELECT name, price, stock_quantity FROM Products WHERE product_id = ?", (product_id,)
+                ).fetchone()
+                if not product_info:
+                    raise ValueError(f"商品 ID {product_id} 不存在。")
+
+                product_name, price, stock_quantity = product_info
+                if stock_quantity < quantity:
+                    raise ValueError(f"商品 '{product_name}' (ID: {product_id}) 庫存不足。目前庫存: {stock_quantity}, 需求: {quantity}")
+
+                total_amount += price * quantity
+                unit_prices[product_id] = price
+                catalog.conn.execute(
+                    "UPDATE Products SET stock_quantity = stock_quantity - ? WHERE product_id = ?",
+                    (quantity, product_id)
+                )
+            reservation_id = catalog.conn.execute(
+                "INSERT INTO stock_reservations (customer_id, items, created_at) VALUES (?, ?, ?)",
+                (customer_id, json.dumps([[item['product_id'], item['quantity']] for item in product_details]),
+                 datetime.now().isoformat())
+            ).lastrowid
+            catalog.conn.commit()
+        except ValueError as ve:
+            catalog.conn.rollback()
+            print(f"事務失敗 (資料錯誤): {ve}")
+            return None
+        except Exception as e:
+            catalog.conn.rollback()
+            print(f"事務失敗 (操作錯誤): {e}")
+            return None
+
+        # 2. 在顧客所在分片中寫入訂單與明細
+        shard_index = self.shard_index_for_customer(customer_id)
+        shard = self.shards[shard_index]
+        try:
+            shard.conn.execute("BEGIN IMMEDIATE;")
+            order_id = self._next_id(shard_index, "Orders")
+            shard.conn.execute(
+                "INSERT INTO Orders (order_id, customer_id, order_date, status, total_amount) VALUES (?, ?, ?, ?, ?)",
+                (order_id, customer_id, datetime.now().isoformat(), "處理中", total_amount)
+            )
+            shard.conn.executemany(
+                "INSERT INTO Order_Items (order_id, product_id, quantity, unit_price) VALUES (?, ?, ?, ?)",
+                [(order_id, item['product_id'], item['quantity'], unit_prices[item['product_id']])
+                 for item in product_details]
+            )
+            shard.conn.execute(
+                "INSERT INTO order_reservations (reservation_id, order_id) VALUES (?, ?)",
+                (reservation_id, order_id)
+            )
+            shard.conn.commit()
+        except Exception as e:
+            shard.conn.rollback()
+            print(f"事務失敗 (操作錯誤): {e}")
+            self._release_reservation(reservation_id, restore_stock=True)
+            return None
+
+        # 3. 訂單已寫入，刪除保留紀錄；失敗時留給 reconcile_reservations() 清除
+        self._release_reservation(reservation_id, restore_stock=False)
+        print(f"成功新增訂單 (ID: {order_id}, 分片 {shard_index}) 及其訂單明細，並更新商品庫存。")
+        return order_id
+
+    def _release_reservation(self, reservation_id, restore_stock):
+        """
+        刪除保留紀錄；restore_stock 為 True 時在同一個事務中把保留的庫存加回商品目錄。
+        成功回傳 True；失敗時保留紀錄仍在，回傳 False，之後由 reconcile_reservations() 處理。
+        """
+        catalog = self.catalog
+        try:
+            catalog.conn.execute("BEGIN IMMEDIATE;")
+            row = catalog.conn.execute(
+                "SELECT items FROM stock_reservations WHERE reservation_id = ?", (reservation_id,)
+            ).fetchone()
+            if row and restore_stock:
+                catalog.conn.executemany(
+                    "UPDATE Products SET stock_quantity = stock_quantity + ? WHERE product_id = ?",
+                    [(quantity, product_id) for product_id, quantity in json.loads(row[0])]
+                )
+            catalog.conn.execute("DELETE FROM stock_reservations WHERE reservation_id = ?", (reservation_id,))
+            catalog.conn.commit()
+            if row and restore_stock:
+                print(f"已還原保留紀錄 {reservation_id} 扣除的商品庫存。")
+            return True
+        except sqlite3.Error as e:
+            catalog.conn.rollback()
+            print(f"處理保留紀錄 {reservation_id} 失敗，請稍後執行 reconcile_reservations(): {e}")
+            return False
+
+    def reconcile_reservations(self, older_than_seconds=300):
+        """
+        處理遺留的庫存保留紀錄 (補償失敗或行程中止時留下)：
+        - 分片中已有對應訂單：訂單已成立，只刪除保留紀錄。
+        - 分片中沒有對應訂單：訂單未成立，還原庫存並刪除保留紀錄。
+        只處理建立超過 older_than_seconds 秒的紀錄，這個時間必須大於結帳事務可能花費的最長時間
+        (含鎖定等待)，以免誤判仍在進行中的結帳。
+        最後清除各分片中已不再需要的 order_reservations。
+        回傳 {"completed": 已成立筆數, "restored": 已還原筆數}。
+        """
+        cutoff = (datetime.now() - timedelta(seconds=older_than_seconds)).isoformat()
+        pending = self.catalog.conn.execute(
+            "SELECT reservation_id, customer_id FROM stock_reservations WHERE created_at < ? ORDER BY reservation_id",
+            (cutoff,)
+        ).fetchall()
+
+        result = {"completed": 0, "restored": 0}
+        for reservation_id, customer_id in pending:
+            shard = self.shards[self.shard_index_for_customer(customer_id)]
+            completed = shard.conn.execute(
+                "SELECT 1 FROM order_reservations WHERE reservation_id = ?", (reservation_id,)
+            ).fetchone() is not None
+            if self._release_reservation(reservation_id, restore_stock=not completed):
+                result["completed" if completed else "restored"] += 1
+
+        # 保留紀錄 ID 由 AUTOINCREMENT 遞增配發：比最小的未處理保留紀錄小 (沒有未處理紀錄時，
+        # 不大於已配發過的最大 ID) 的保留紀錄都已處理完，對應的 order_reservations 不再需要。
+        # 以單一查詢讀取，確保兩個值來自同一個快照。
+        oldest_pending = self.catalog.conn.execute("""
+            SELECT COALESCE(
+                (SELECT MIN(reservation_id) FROM stock_reservations),
+                (SELECT seq + 1 FROM sqlite_sequence WHERE name = 'stock_reservations'),
+                1
+            )
+        """).fetchone()[0]
+        for shard in self.shards:
+            shard.conn.execute("DELETE FROM order_reservations WHERE reservation_id < ?", (oldest_pending,))
+            shard.conn.commit()
+        print(f"保留紀錄處理完成：{result}")
+        return result
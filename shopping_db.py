@@ -1,99 +1,237 @@
 import sqlite3
 from datetime import datetime
 
+def table_version_statements(table_names):
+    """
+    產生資料表變更版本的遷移語句：table_versions 記錄每個資料表的變更次數與最後修改時間，
+    由觸發器在每次 INSERT/UPDATE/DELETE 時遞增，因此所有寫入路徑（包含外鍵連帶刪除）都會被計入。
+    """
+    statements = ["""
+        CREATE TABLE IF NOT EXISTS table_versions (
+            table_name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            updated_at INTEGER NOT NULL
+        );
+    """]
+    for table_name in table_names:
+        statements.append(
+            "INSERT OR IGNORE INTO table_versions (table_name, version, updated_at) "
+            f"VALUES ('{table_name}', 0, CAST(strftime('%s', 'now') AS INTEGER));"
+        )
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            statements.append(f"""
+                CREATE TRIGGER IF NOT EXISTS {table_name}_{event.lower()}_version
+                AFTER {event} ON {table_name}
+                BEGIN
+                    UPDATE table_versions
+                    SET version = version + 1, updated_at = CAST(strftime('%s', 'now') AS INTEGER)
+                    WHERE table_name = '{table_name}';
+                END;
+            """)
+    return statements
+
+
+# --- 資料表定義 (DDL) ---
+# 各資料表的建立語句只定義一次，供 MIGRATIONS 與 sharded_db 的遷移列表共用。
+# 這些是第 1 版的結構；之後的結構變更請新增遷移版本，不要直接修改這裡的語句。
+PRODUCTS_DDL = """
+    CREATE TABLE IF NOT EXISTS Products (
+        product_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        description TEXT,
+        price REAL NOT NULL,
+        stock_quantity INTEGER NOT NULL,
+        category TEXT
+    );
+"""
+
+SUPPLIERS_DDL = """
+    CREATE TABLE IF NOT EXISTS Suppliers (
+        supplier_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        contact_email TEXT,
+        phone TEXT,
+        address TEXT
+    );
+"""
+
+PRODUCT_SUPPLIERS_DDL = """
+    CREATE TABLE IF NOT EXISTS Product_Suppliers (
+        product_id INTEGER,
+        supplier_id INTEGER,
+        supply_price REAL NOT NULL,
+        PRIMARY KEY (product_id, supplier_id),
+        FOREIGN KEY (product_id) REFERENCES Products(product_id) ON DELETE CASCADE,
+        FOREIGN KEY (supplier_id) REFERENCES Suppliers(supplier_id) ON DELETE CASCADE
+    );
+"""
+
+CUSTOMERS_DDL = """
+    CREATE TABLE IF NOT EXISTS Customers (
+        customer_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        email TEXT UNIQUE NOT NULL,
+        password TEXT NOT NULL,
+        phone TEXT,
+        address TEXT
+    );
+"""
+
+ORDERS_DDL = """
+    CREATE TABLE IF NOT EXISTS Orders (
+        order_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        customer_id INTEGER NOT NULL,
+        order_date TEXT NOT NULL,
+        status TEXT NOT NULL,
+        total_amount REAL NOT NULL,
+        FOREIGN KEY (customer_id) REFERENCES Customers(customer_id) ON DELETE CASCADE
+    );
+"""
+
+ORDER_ITEMS_DDL = """
+    CREATE TABLE IF NOT EXISTS Order_Items (
+        order_id INTEGER,
+        product_id INTEGER,
+        quantity INTEGER NOT NULL,
+        unit_price REAL NOT NULL,
+        PRIMARY KEY (order_id, product_id),
+        FOREIGN KEY (order_id) REFERENCES Orders(order_id) ON DELETE CASCADE,
+        FOREIGN KEY (product_id) REFERENCES Products(product_id) ON DELETE CASCADE
+    );
+"""
+
+# NOCASE 索引讓 LIKE '前綴%' 查詢可以使用索引 (預設 case_sensitive_like = OFF)
+PRODUCTS_NAME_INDEX = "CREATE INDEX IF NOT EXISTS idx_products_name ON Products (name COLLATE NOCASE);"
+CUSTOMERS_NAME_INDEX = "CREATE INDEX IF NOT EXISTS idx_customers_name ON Customers (name COLLATE NOCASE);"
+
+
+# --- 資料庫結構版本 (Schema Migrations) ---
+# 依版本號排序的遷移腳本：(版本, 說明, [SQL 語句...])。
+# 已套用的版本記錄在 schema_version 資料表中；修改結構時請新增一個版本，不要改動既有版本。
+MIGRATIONS = [
+    (1, "建立初始資料表", [
+        PRODUCTS_DDL, SUPPLIERS_DDL, PRODUCT_SUPPLIERS_DDL, CUSTOMERS_DDL, ORDERS_DDL, ORDER_ITEMS_DDL,
+    ]),
+    (2, "新增資料表變更版本 (table_versions)", table_version_statements(
+        ["Products", "Suppliers", "Product_Suppliers", "Customers", "Orders", "Order_Items"]
+    )),
+    (3, "新增名稱前綴查詢索引", [PRODUCTS_NAME_INDEX, CUSTOMERS_NAME_INDEX]),
+]
+
 class OnlineShoppingDB:
-    def __init__(self, db_name="online_shopping.db"):
+    def __init__(self, db_name="online_shopping.db", migrations=MIGRATIONS):
         """
-        初始化資料庫連接，並建立資料表（如果不存在）。
+        初始化資料庫連接。
+        建立或升級資料表請呼叫 migrate()，每次部署執行一次即可，不必在每個連線上重做。
+        migrations: 此資料庫使用的遷移腳本列表，預設為完整結構 MIGRATIONS。
         """
         self.db_name = db_name
+        self.migrations = migrations
         self.conn = None
         self.cursor = None
         self._connect()
-        self._create_tables()
 
     def _connect(self):
         """建立資料庫連接。"""
         try:
             self.conn = sqlite3.connect(self.db_name)
             self.cursor = self.conn.cursor()
+            self.conn.execute("PRAGMA foreign_keys = ON;") # 啟用外鍵約束
             print(f"成功連接到資料庫：{self.db_name}")
         except sqlite3.Error as e:
             print(f"資料庫連接失敗：{e}")
 
-    def _create_tables(self):
-        """建立所有資料表。"""
-        tables = {
-            "Products": """
-                CREATE TABLE IF NOT EXISTS Products (
-                    product_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT NOT NULL,
-                    description TEXT,
-                    price REAL NOT NULL,
-                    stock_quantity INTEGER NOT NULL,
-                    category TEXT
-                );
-            """,
-            "Suppliers": """
-                CREATE TABLE IF NOT EXISTS Suppliers (
-                    supplier_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT NOT NULL,
-                    contact_email TEXT,
-                    phone TEXT,
-                    address TEXT
-                );
-            """,
-            "Product_Suppliers": """
-                CREATE TABLE IF NOT EXISTS Product_Suppliers (
-                    product_id INTEGER,
-                    supplier_id INTEGER,
-                    supply_price REAL NOT NULL,
-                    PRIMARY KEY (product_id, supplier_id),
-                    FOREIGN KEY (product_id) REFERENCES Products(product_id) ON DELETE CASCADE,
-                    FOREIGN KEY (supplier_id) REFERENCES Suppliers(supplier_id) ON DELETE CASCADE
-                );
-            """,
-            "Customers": """
-                CREATE TABLE IF NOT EXISTS Customers (
-                    customer_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT NOT NULL,
-                    email TEXT UNIQUE NOT NULL,
-                    password TEXT NOT NULL,
-                    phone TEXT,
-                    address TEXT
-                );
-            """,
-            "Orders": """
-                CREATE TABLE IF NOT EXISTS Orders (
-                    order_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    customer_id INTEGER NOT NULL,
-                    order_date TEXT NOT NULL,
-                    status TEXT NOT NULL,
-                    total_amount REAL NOT NULL,
-                    FOREIGN KEY (customer_id) REFERENCES Customers(customer_id) ON DELETE CASCADE
-                );
-            """,
-            "Order_Items": """
-                CREATE TABLE IF NOT EXISTS Order_Items (
-                    order_id INTEGER,
-                    product_id INTEGER,
-                    quantity INTEGER NOT NULL,
-                    unit_price REAL NOT NULL,
-                    PRIMARY KEY (order_id, product_id),
-                    FOREIGN KEY (order_id) REFERENCES Orders(order_id) ON DELETE CASCADE,
-                    FOREIGN KEY (product_id) REFERENCES Products(product_id) ON DELETE CASCADE
-                );
-            """
-        }
-
-        self.conn.execute("PRAGMA foreign_keys = ON;") # 啟用外鍵約束
-        for table_name, create_sql in tables.items():
+    def enable_wal(self, busy_timeout_ms=30000):
+        """
+        切換為 WAL 模式並設定鎖定等待時間，讓多個行程同時讀寫時讀取不會被寫入阻擋，
+        寫入也會等待鎖而不是立即失敗。journal_mode 會保存在資料庫檔案中。
+        """
+        self.conn.execute(f"PRAGMA busy_timeout = {int(busy_timeout_ms)};")
+        self.conn.execute("PRAGMA journal_mode = WAL;")
+
+    # --- 結構版本 (Schema Version) ---
+    def schema_version(self):
+        """回傳目前已套用的最新結構版本；尚未建立 schema_version 資料表時回傳 0。"""
+        try:
+            row = self.conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+        except sqlite3.OperationalError:
+            return 0
+        return row[0] or 0
+
+    def database_id(self):
+        """
+        回傳可識別這個資料庫檔案的值：第一個結構版本的套用時間（精確到微秒）。
+        資料庫被刪除後重建時會得到不同的值，可與 table_versions() 一起產生 ETag，
+        避免新資料庫的計數器恰好與舊資料庫相同而誤判為未修改。尚未遷移時回傳 None。
+        """
+        try:
+            row = self.conn.execute("SELECT applied_at FROM schema_version WHERE version = 1").fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return row[0] if row else None
+
+    def needs_migration(self):
+        """只做一次查詢，判斷是否有尚未套用的遷移腳本。"""
+        return self.schema_version() < self.migrations[-1][0]
+
+    def migrate(self):
+        """
+        依序套用尚未執行的遷移腳本，可重複呼叫（冪等）。
+        每個版本在自己的事務中執行，並以 BEGIN IMMEDIATE 取得寫入鎖，
+        多個行程同時啟動時只有一個會真正執行遷移。
+        回傳套用後的結構版本。
+        """
+        if not self.needs_migration():
+            return self.schema_version()
+
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TEXT NOT NULL
+            );
+        """)
+        self.conn.commit()
+
+        for version, description, statements in self.migrations:
             try:
-                self.cursor.execute(create_sql)
+                self.conn.execute("BEGIN IMMEDIATE;")
+                # 取得鎖之後再檢查一次，避免與其他行程重複套用
+                applied = self.conn.execute(
+                    "SELECT 1 FROM schema_version WHERE version = ?", (version,)
+                ).fetchone()
+                if applied:
+                    self.conn.rollback()
+                    continue
+                for statement in statements:
+                    self.conn.execute(statement)
+                self.conn.execute(
+                    "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                    (version, description, datetime.now().isoformat())
+                )
                 self.conn.commit()
-                print(f"資料表 '{table_name}' 建立成功或已存在。")
+                print(f"已套用資料庫結構版本 {version}：{description}")
             except sqlite3.Error as e:
-                print(f"建立資料表 '{table_name}' 失敗: {e}")
+                self.conn.rollback()
+                print(f"套用資料庫結構版本 {version} 失敗: {e}")
+                raise
+        return self.schema_version()
+
+    def table_versions(self, table_names):
+        """
+        回傳 {資料表名稱: (變更版本, 最後修改時間 epoch 秒)}。
+        只讀取 table_versions 這張小表，不會掃描資料表本身，適合用來產生 HTTP ETag。
+        """
+        placeholders = ', '.join(['?' for _ in table_names])
+        rows = self.conn.execute(
+            f"SELECT table_name, version, updated_at FROM table_versions WHERE table_name IN ({placeholders})",
+            list(table_names)
+        ).fetchall()
+        return {table_name: (version, updated_at) for table_name, version, updated_at in rows}
+
+    def is_empty(self, table_name):
+        """檢查資料表是否沒有任何資料（只讀取一列，不做全表掃描）。"""
+        return self.conn.execute(f"SELECT 1 FROM {table_name} LIMIT 1").fetchone() is None
 
     def close(self):
         """關閉資料庫連接。"""
@@ -130,6 +268,28 @@ class OnlineShoppingDB:
             return None # 必須有條件才能精確查詢一筆
         return self.cursor.fetchone()
 
+    def fetch_by_prefix(self, table_name, columns, column, prefix, limit=10):
+        """
+        依欄位前綴查詢（不分大小寫），只取回 columns 指定的欄位，
+        依該欄位排序（同值時依 columns 第一欄）並最多回傳 limit 筆。
+        欄位需有 COLLATE NOCASE 索引才能避免全表掃描；prefix 中的 % 和 _ 會被跳脫。
+        """
+        pattern = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        self.cursor.execute(
+            f"SELECT {', '.join(columns)} FROM {table_name} WHERE {column} LIKE ? ESCAPE '\\' "
+            f"ORDER BY {column} COLLATE NOCASE, {columns[0]} LIMIT ?",
+            (pattern, limit)
+        )
+        return self.cursor.fetchall()
+
+    def fetch_many(self, table_name, column, values):
+        """以單一 IN 查詢取得 column 值在 values 中的所有資料。"""
+        if not values:
+            return []
+        placeholders = ', '.join(['?' for _ in values])
+        self.cursor.execute(f"SELECT * FROM {table_name} WHERE {column} IN ({placeholders})", list(values))
+        return self.cursor.fetchall()
+
     # --- 新增 (Insert) ---
     def insert_data(self, table_name, data):
         """
@@ -195,8 +355,8 @@ class OnlineShoppingDB:
         product_details: 列表，每個元素為字典 {'product_id': id, 'quantity': qty}
         """
         try:
-            # 開始事務
-            self.conn.execute("BEGIN TRANSACTION;")
+            # 開始事務；IMMEDIATE 先取得寫入鎖，避免多個行程同時讀取後升級寫入鎖時直接失敗
+            self.conn.execute("BEGIN IMMEDIATE;")
 
             # 1. 計算訂單總金額並檢查庫存
             total_amount = 0
@@ -270,6 +430,7 @@ class OnlineShoppingDB:
 # --- 使用範例 ---
 if __name__ == "__main__":
     db = OnlineShoppingDB()
+    db.migrate()
 
     print("\n--- 1. 插入初始資料 ---")
     # 插入商品